@@ -4,11 +4,11 @@
 專案目標：提供台股全市場快速篩選、技術分析、可視化工具
 主要特色：
   • FinMind API 自動更新股票清單與產業分類
-  • yfinance 價格資料 + 本地 pickle 快取（避免 rate limit）
+  • yfinance 價格資料 + 本地 price_cache/ 快取（每檔一個 zstd Parquet，避免 rate limit）
   • 四種模式：手動查詢、條件篩選、自動掃描、收藏追蹤
   • 技術訊號：三角收斂、箱型整理、爆量、MA排列
   • Plotly K線圖 + 壓力/支撐趨勢線
-  • data_editor 即時勾選收藏（跨模式同步）
+  • 唯讀結果表 + 表單內多選框儲存收藏（跨模式同步）
   • 批次更新進度條、錯誤處理、使用者提示
 使用建議流程：
 1. 第一次執行 → 側邊欄「更新股票清單 JSON (FinMind)」
@@ -25,18 +25,24 @@ import pandas as pd
 import numpy as np
 import yfinance as yf
 import plotly.graph_objects as go
-from scipy.stats import linregress
-from streamlit_autorefresh import st_autorefresh
 import pickle
 from pathlib import Path
 import time
 from datetime import datetime
 import json
+try:
+    import orjson  # 選用：C 實作的 JSON 解析/序列化，未安裝時退回標準庫 json
+except ImportError:
+    orjson = None
+from functools import lru_cache
+from collections import OrderedDict
 import warnings
 import requests
 import traceback
 import sys
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 忽略常見警告，讓介面更乾淨
 warnings.filterwarnings("ignore", category=FutureWarning)
@@ -73,17 +79,53 @@ if 'last_mode' not in st.session_state:
 if 'full_db' not in st.session_state:
     st.session_state.full_db = None
 
+if 'db_indexes' not in st.session_state:
+    st.session_state.db_indexes = None  # (代號→名稱, 產業→代號清單)，隨 full_db 一起建立
+
 if 'price_cache' not in st.session_state:
     st.session_state.price_cache = None
 
 if 'last_cache_update' not in st.session_state:
     st.session_state.last_cache_update = None
 
+if 'dirty_prices' not in st.session_state:
+    st.session_state.dirty_prices = set()  # 已下載、尚未寫入 parquet 的代號
+
+if 'analysis_memo' not in st.session_state:
+    st.session_state.analysis_memo = OrderedDict()  # (代號, 最後日期, 尾段價量, 參數) → 分析結果，LRU
+
 # ────────────────────────────────────────────────
 #               檔案路徑定義
 # ────────────────────────────────────────────────
 STOCK_JSON_PATH = Path("taiwan_full_market.json")
-PRICE_CACHE_PATH = Path("taiwan_stock_prices.pkl")
+PRICE_CACHE_DIR = Path("price_cache")                     # 每檔一個 parquet
+LEGACY_PRICE_CACHE_PATH = Path("taiwan_stock_prices.pkl")  # 舊版整包 pickle，只用於一次性搬移
+
+def json_loads(data: bytes):
+    """解析 UTF-8 JSON（有 orjson 就用 orjson）；格式錯誤一律丟 json.JSONDecodeError"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # 舊版 update_db.py 產生的清單含非標準的 NaN，orjson 不接受，交給標準庫容錯解析
+            return json.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj) -> bytes:
+    """序列化成縮排 2 格、中文不轉義的 UTF-8 bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+# ────────────────────────────────────────────────
+#          共用 HTTP 連線（跨 rerun 重用）
+# ────────────────────────────────────────────────
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """整個伺服器程序只建立一次 Session，DNS 解析與 TCP/TLS 連線在每次 rerun 間共用"""
+    session = requests.Session()
+    session.headers.update({"User-Agent": "Mozilla/5.0 (taiwan-stock-scanner)"})
+    return session
 
 # ────────────────────────────────────────────────
 #          FinMind API 更新股票清單（強制覆蓋）
@@ -93,9 +135,9 @@ def update_stock_json_from_finmind():
     url = "https://api.finmindtrade.com/api/v4/data"
     params = {"dataset": "TaiwanStockInfo"}
     try:
-        r = requests.get(url, params=params, timeout=20)
+        r = get_http_session().get(url, params=params, timeout=20)
         r.raise_for_status()
-        result = r.json()
+        result = json_loads(r.content)
         if not result.get("success", True):
             st.error(f"FinMind API 失敗：{result.get('msg', '未知錯誤')}")
             return None, 0
@@ -115,9 +157,10 @@ def update_stock_json_from_finmind():
                     "category": str(category).strip()
                 }
         
-        # 強制覆蓋寫入
-        with open(STOCK_JSON_PATH, "w", encoding="utf-8") as f:
-            json.dump(stock_dict, f, ensure_ascii=False, indent=2)
+        # 強制覆蓋寫入：先寫暫存檔再原子替換，避免寫到一半留下壞掉的 JSON
+        tmp_path = STOCK_JSON_PATH.with_name(STOCK_JSON_PATH.name + ".tmp")
+        tmp_path.write_bytes(json_dumps(stock_dict))
+        os.replace(tmp_path, STOCK_JSON_PATH)
         
         st.success(f"成功覆蓋更新 {len(stock_dict)} 檔股票清單 → {STOCK_JSON_PATH}")
         return stock_dict, len(stock_dict)
@@ -133,12 +176,24 @@ def update_stock_json_from_finmind():
 # ────────────────────────────────────────────────
 #          載入股票資料庫（超強防呆版）
 # ────────────────────────────────────────────────
-def load_stock_database():
-    """載入 taiwan_full_market.json，處理各種異常格式"""
+def stock_json_mtime() -> float:
+    """股票清單 JSON 的修改時間（不存在時為 0），作為 load_stock_database 的快取鍵"""
+    try:
+        return STOCK_JSON_PATH.stat().st_mtime
+    except OSError:
+        return 0.0
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_stock_database(json_mtime: float):
+    """
+    載入 taiwan_full_market.json，處理各種異常格式
+    
+    以 cache_resource 在整個伺服器程序共用同一份 dict（唯讀），新的 session 不必重新解析 JSON；
+    json_mtime 只當快取鍵：每日排程提交新檔（或原本缺檔、後來補上）時，新 session 會自動重新載入
+    """
     if STOCK_JSON_PATH.exists():
         try:
-            with open(STOCK_JSON_PATH, 'r', encoding='utf-8') as f:
-                raw = json.load(f)
+            raw = json_loads(STOCK_JSON_PATH.read_bytes())
             
             db = {}
             abnormal_count = 0
@@ -192,71 +247,438 @@ def load_stock_database():
     }
     return fallback_db
 
+def build_db_indexes(db: dict) -> tuple[dict, dict]:
+    """
+    代號→名稱對照表與產業→代號清單反查表（清單維持 JSON 原順序）
+    
+    資料庫載入時建一次，之後每輪 rerun 的名稱查詢與產業篩選都只是一次 dict 查詢
+    """
+    name_of, industry_index = {}, {}
+    for sym, info in db.items():
+        name_of[sym] = info["name"]
+        industry_index.setdefault(info["category"], []).append(sym)
+    return name_of, industry_index
+
 # 載入資料庫（只執行一次）
 if st.session_state.full_db is None:
-    st.session_state.full_db = load_stock_database()
+    st.session_state.full_db = load_stock_database(stock_json_mtime())
+    st.session_state.db_indexes = build_db_indexes(st.session_state.full_db)
 full_db = st.session_state.full_db
+name_of, industry_index = st.session_state.db_indexes
 
 # ────────────────────────────────────────────────
 #               價格快取管理
 # ────────────────────────────────────────────────
+def price_cache_file(symbol: str) -> Path:
+    return PRICE_CACHE_DIR / f"{symbol}.parquet"
+
+# 寫入快取時一併算好的指標欄位，掃描時只取最後一列，不必每次 rolling
+INDICATOR_COLS = ["MA20", "MA60", "Vol5"]
+# 快取一律存 float32：台股價格最多 2 位小數，記憶體與 parquet 大小都減半
+PRICE_DTYPE = "float32"
+# 分析用欄位：價量取回看區間，均線/均量直接讀最後一列的預算值
+ANALYSIS_COLS = ["Close", "High", "Low", "Volume"] + INDICATOR_COLS
+
+def prepare_price_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    就地把 OHLCV 轉成 float32、加上 MA20 / MA60 / Vol5（前 5 日均量，不含當日）並回傳 df
+    
+    指標以 float64 計算後才轉型；Vol5 與原本逐檔的 .mean() 一致：略過 NaN，5 天全缺才是 NaN
+    """
+    if "Close" in df.columns and "Volume" in df.columns:
+        df["MA20"] = df["Close"].astype(np.float64).rolling(20).mean()
+        df["MA60"] = df["Close"].astype(np.float64).rolling(60).mean()
+        df["Vol5"] = df["Volume"].astype(np.float64).rolling(5, min_periods=1).mean().shift(1)
+    for col in ["Open", "High", "Low", "Close", "Volume"] + INDICATOR_COLS:
+        if col in df.columns and df[col].dtype != PRICE_DTYPE:
+            df[col] = df[col].astype(PRICE_DTYPE)
+    return df
+
+def save_price_cache(cache, symbols):
+    """只寫入有變動的代號（每檔一個 parquet），不再整包重寫全部快取"""
+    try:
+        PRICE_CACHE_DIR.mkdir(exist_ok=True)
+        for sym in symbols:
+            cache[sym].to_parquet(price_cache_file(sym), engine="pyarrow", compression="zstd")
+    except Exception as e:
+        st.error(f"儲存價格快取失敗：{str(e)}")
+
+def flush_price_cache():
+    """把累積的新下載代號一次寫入 parquet（每輪 rerun 的模式邏輯結束後呼叫）"""
+    dirty = st.session_state.dirty_prices
+    if dirty:
+        save_price_cache(price_cache, sorted(dirty))
+        dirty.clear()
+
+@st.cache_resource(show_spinner=False)
 def load_price_cache():
-    if PRICE_CACHE_PATH.exists():
+    """
+    記憶體快取啟動時是空的，個股第一次用到才從 parquet 讀入（見 get_cached_price）
+    
+    以 cache_resource 讓所有 session 共用同一個 dict：別的分頁讀過或下載過的代號直接命中記憶體；
+    若只有舊版 pickle，則一次性轉成每檔 parquet
+    """
+    cache = {}
+    if LEGACY_PRICE_CACHE_PATH.exists() and not PRICE_CACHE_DIR.exists():
         try:
-            with open(PRICE_CACHE_PATH, 'rb') as f:
+            with open(LEGACY_PRICE_CACHE_PATH, 'rb') as f:
                 data = pickle.load(f)
-                return data if isinstance(data, dict) else {}
+            if isinstance(data, dict):
+                cache = {
+                    sym: prepare_price_frame(df) for sym, df in data.items()
+                    if isinstance(df, pd.DataFrame) and not df.empty
+                }
+                save_price_cache(cache, list(cache))
+                st.info(f"已將舊版價格快取轉存為 parquet：{len(cache)} 檔")
         except Exception as e:
             st.error(f"讀取價格快取失敗：{str(e)}")
-    return {}
-
-def save_price_cache(cache):
-    try:
-        with open(PRICE_CACHE_PATH, 'wb') as f:
-            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
-    except Exception as e:
-        st.error(f"儲存價格快取失敗：{str(e)}")
+    return cache
 
 if st.session_state.price_cache is None:
     st.session_state.price_cache = load_price_cache()
 price_cache = st.session_state.price_cache
 
+@st.cache_resource(show_spinner=False)
+def load_price_arrays():
+    """代號 → ANALYSIS_COLS 的 float32 矩陣 (rows, 7)，第一次分析時從 price_cache 轉換，所有 session 共用"""
+    return {}
+
+price_arrays = load_price_arrays()
+
+@st.cache_resource(show_spinner=False)
+def get_price_lock() -> threading.Lock:
+    """
+    price_cache / price_arrays 由所有 session 的執行緒共用，寫入時以這把鎖保持兩者一致
+    
+    避免 A 分頁正從舊資料轉矩陣時，B 分頁寫入新資料，結果舊矩陣又被存回去
+    """
+    return threading.Lock()
+
+price_lock = get_price_lock()
+
+def store_price(symbol: str, df: pd.DataFrame):
+    """寫入記憶體快取；舊的分析矩陣作廢，下次 get_price_array 再依新資料轉換"""
+    with price_lock:
+        price_cache[symbol] = df
+        price_arrays.pop(symbol, None)
+
+def get_price_array(symbol: str) -> np.ndarray | None:
+    """
+    取分析用矩陣（每檔只從 DataFrame 轉一次），掃描熱路徑只做 NumPy 切片
+    
+    沒有快取或缺欄位時回傳 None
+    """
+    arr = price_arrays.get(symbol)
+    if arr is None:
+        df = get_cached_price(symbol)
+        if df is None or not all(col in df.columns for col in ANALYSIS_COLS):
+            return None
+        arr = df[ANALYSIS_COLS].to_numpy(dtype=np.float32)
+        with price_lock:
+            # 轉換期間若已被別的 session 換成新資料，就不存這份舊矩陣
+            if price_cache.get(symbol) is df:
+                price_arrays[symbol] = arr
+    return arr
+
+def get_cached_price(symbol: str) -> pd.DataFrame | None:
+    """記憶體快取 → 本地 parquet；都沒有（或為空）時回傳 None"""
+    df = price_cache.get(symbol)
+    if df is None:
+        path = price_cache_file(symbol)
+        if not path.exists():
+            return None
+        try:
+            df = pd.read_parquet(path, engine="pyarrow")
+        except Exception as e:
+            st.warning(f"讀取 {symbol} 價格快取失敗：{str(e)}")
+            return None
+        if "MA20" not in df.columns or df["Close"].dtype != PRICE_DTYPE:
+            prepare_price_frame(df)  # 舊版 parquet（float64、無指標欄位）讀入時補算，下次寫檔才會落地
+        store_price(symbol, df)
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return None
+    return df
+
 def fetch_price(symbol: str) -> pd.DataFrame:
-    """優先從快取取，若無則下載並儲存"""
-    if symbol in price_cache:
-        df = price_cache[symbol]
-        if isinstance(df, pd.DataFrame) and not df.empty:
-            return df.copy()
+    """
+    優先從快取取，若無則下載並儲存
     
+    回傳的就是快取裡的同一個 DataFrame（不複製），呼叫端只能讀、不可修改
+    """
+    df = get_cached_price(symbol)
+    if df is not None:
+        return df
+    
+    # 與批次下載走同一條路：經過 download_throttle 排隊，不會和其他分頁的全市場更新同時呼叫 yf.download
     try:
-        df = yf.download(
-            symbol,
-            period="1y",
+        if download_price_batch([symbol]):
+            st.session_state.dirty_prices.add(symbol)  # 延後到掃描結束再寫檔
+            st.session_state.last_cache_update = datetime.now()
+            return price_cache[symbol]
+    except Exception as e:
+        st.warning(f"下載 {symbol} 失敗：{str(e)}")
+    return pd.DataFrame()
+
+PRICE_BATCH_SIZE = 80
+PRICE_HISTORY_PERIOD = "1y"   # 完整歷史（新代號或快取太舊）
+RECENT_PERIOD = "5d"          # 增量更新只抓最後幾根
+# 快取最後一根距今不超過這個天數，5 個交易日的增量一定接得上，不會留下缺口
+INCREMENTAL_MAX_GAP = pd.Timedelta(days=4)
+PRICE_REVISION_RTOL = 1e-3    # 增量資料與快取重疊日的收盤價相對誤差超過此值，視為還原價已改寫
+PRICE_DOWNLOAD_WORKERS = 4    # 全市場更新時同時處理的批次數
+PRICE_REQUEST_INTERVAL = 1.2  # 相鄰兩次 yf.download 開始的最短間隔（秒），避免被 Yahoo 限流
+
+class RequestThrottle:
+    """
+    yf.download 排隊用：同一時間只放行一個請求，且兩次開始至少相隔 interval 秒
+    
+    舊版 yfinance 的下載暫存是模組全域變數，並行呼叫會互相覆蓋，所以請求本身不並行；
+    並行的是請求之後的拆檔、合併與指標計算
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_start = 0.0
+
+    def __enter__(self):
+        self.lock.acquire()
+        wait = self.last_start + self.interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+        return False
+
+@st.cache_resource(show_spinner=False)
+def get_download_throttle() -> RequestThrottle:
+    """全行程共用一個節流器：多個分頁同時更新也不會超過請求頻率"""
+    return RequestThrottle(PRICE_REQUEST_INTERVAL)
+
+download_throttle = get_download_throttle()
+
+def merge_recent_prices(cached: pd.DataFrame, recent: pd.DataFrame) -> pd.DataFrame | None:
+    """
+    把最近幾天的 K 棒接到既有快取後面（同一天以新資料為準），只保留最近一年
+    
+    auto_adjust 的還原價在除權息後會整段改寫：重疊日期的收盤價對不上時回傳 None，
+    由呼叫端改抓完整歷史。最新一根可能是盤中價，不列入比對
+    """
+    overlap = cached.index.intersection(recent.index[:-1])
+    if overlap.empty or not np.allclose(
+        cached.loc[overlap, "Close"].to_numpy(dtype=np.float64),
+        recent.loc[overlap, "Close"].to_numpy(dtype=np.float64),
+        rtol=PRICE_REVISION_RTOL,
+        atol=0.0
+    ):
+        return None
+    merged = pd.concat([cached.drop(columns=INDICATOR_COLS, errors="ignore"), recent])
+    merged = merged[~merged.index.duplicated(keep="last")].sort_index()
+    return merged.loc[merged.index > merged.index[-1] - pd.DateOffset(years=1)]
+
+def download_price_batch(symbols: list[str], period: str = PRICE_HISTORY_PERIOD) -> list[str]:
+    """
+    一次 yf.download 多檔（group_by="ticker"），拆成單檔寫入記憶體快取，回傳成功的代號
+    
+    period 不是完整歷史時視為增量更新：新 K 棒接到既有快取後面，指標重新計算；
+    沒有快取的代號不寫入（只有幾天資料不夠分析），還原價已改寫的代號最後再整批抓完整歷史
+    """
+    with download_throttle:
+        multi_data = yf.download(
+            symbols,
+            period=period,
             interval="1d",
+            group_by="ticker",
             auto_adjust=True,
             progress=False,
-            threads=False
+            threads=True
         )
-        if not df.empty:
-            if isinstance(df.columns, pd.MultiIndex):
-                df.columns = df.columns.get_level_values(0)
-            price_cache[symbol] = df.copy()
-            save_price_cache(price_cache)
-            st.session_state.last_cache_update = datetime.now()
-        return df
-    except Exception as e:
-        st.warning(f"下載 {symbol} 失敗：{str(e)}")
-        return pd.DataFrame()
+    updated, revised = [], []
+    for sym in symbols:
+        if isinstance(multi_data.columns, pd.MultiIndex):
+            if sym not in multi_data.columns.levels[0]:
+                continue
+            df = multi_data[sym]
+        elif len(symbols) == 1:
+            df = multi_data
+        else:
+            continue
+        # 下載失敗的代號會是整列 NaN，不寫進快取
+        df = df.dropna(how="all")
+        if df.empty:
+            continue
+        if period != PRICE_HISTORY_PERIOD:
+            cached = get_cached_price(sym)
+            if cached is None:
+                continue
+            df = merge_recent_prices(cached, df)
+            if df is None:
+                revised.append(sym)
+                continue
+        store_price(sym, prepare_price_frame(df.copy()))
+        updated.append(sym)
+    if revised:
+        try:
+            updated += download_price_batch(revised, PRICE_HISTORY_PERIOD)
+        except Exception:
+            # 重抓失敗就保留舊快取，下次更新時會再比對一次
+            traceback.print_exc(file=sys.stderr)
+    return updated
+
+def prefetch_prices(symbols: list[str]) -> int:
+    """
+    掃描前先把快取缺少的代號批次補齊（每批 PRICE_BATCH_SIZE 檔一個請求），
+    之後的 fetch_price 全部命中快取，不再逐檔連線
+    """
+    missing = [s for s in symbols if get_cached_price(s) is None]
+    if not missing:
+        return 0
+
+    downloaded = []
+    for batch_idx in range(0, len(missing), PRICE_BATCH_SIZE):
+        batch_list = missing[batch_idx : batch_idx + PRICE_BATCH_SIZE]
+        try:
+            downloaded += download_price_batch(batch_list)
+        except Exception as batch_err:
+            st.warning(f"批次下載失敗（{len(batch_list)} 檔）：{batch_err}")
+
+    if downloaded:
+        st.session_state.dirty_prices.update(downloaded)
+        st.session_state.last_cache_update = datetime.now()
+    return len(downloaded)
 
 # ────────────────────────────────────────────────
 #               核心技術分析函式
 # ────────────────────────────────────────────────
+@lru_cache(maxsize=8)
+def _regression_axis(n: int) -> tuple[float, np.ndarray, float]:
+    """x = 0..n-1 的平均、去平均值後的 x 與平方和；同一個回看天數只算一次"""
+    x = np.arange(n, dtype=np.float64)
+    x_mean = x.mean()
+    x_centered = x - x_mean
+    return x_mean, x_centered, float((x_centered ** 2).sum())
+
+
+def fit_lines(y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    最小平方法直線擬合（x = 0..n-1），沿最後一軸對每一列同時計算
+    
+    y : shape (..., n)
+    回傳 (slope, intercept)，shape 皆為 (...)
+    取代 scipy.stats.linregress：只算用得到的斜率與截距，不算 r / p-value / stderr
+    """
+    x_mean, x_centered, ss_x = _regression_axis(y.shape[-1])
+    # Σ(x-x̄)(y-ȳ) = Σ(x-x̄)·y，因為 Σ(x-x̄) = 0
+    slope = (y * x_centered).sum(axis=-1) / ss_x
+    intercept = y.mean(axis=-1) - slope * x_mean
+    return slope, intercept
+
+
+# 本 session 分析結果 LRU 上限（自動掃描每分鐘重跑，盤後最後一根不變就直接沿用）
+ANALYSIS_MEMO_SIZE = 4000
+
+# 結果只保留畫 K 線圖需要的最後幾根（快取 DataFrame 的切片，不另外複製）
+CHART_BARS = 60
+
+# 訊號以位元表示，只有要顯示時才組成文字（依序：三角、箱型、爆量）
+SIG_TRI, SIG_BOX, SIG_VOL = 1, 2, 4
+SIGNAL_NAMES = {SIG_TRI: "📐三角收斂", SIG_BOX: "📦箱型整理", SIG_VOL: "🚀今日爆量"}
+
+# run_analysis 實際用到的參數；scan_limit 等不影響單檔結果的設定不進快取鍵
+ANALYSIS_CFG_KEYS = ("p_lookback", "min_price", "check_tri", "check_box", "check_vol", "f_ma_filter")
+
+
+@st.cache_data(ttl=3600, max_entries=5000, show_spinner=False)
+def analyze_tail(
+    sid: str,
+    last_bar: str,
+    tail: np.ndarray,
+    cfg_items: tuple,
+    is_manual: bool
+) -> dict | None:
+    """
+    單檔分析的純計算部分（不碰 session_state、不輸出 UI），結果依參數快取
+    
+    sid / last_bar : 股票代碼與最後一根 K 棒日期，作為快取鍵的一部分
+    tail : 最後「回看天數」根的 ANALYSIS_COLS，shape (lookback, 7)，
+           以內容雜湊，盤中同一天價格變動也會重算
+    cfg_items : ANALYSIS_CFG_KEYS 對應的 (key, value) tuple
+    回傳不含 df 的輕量結果；不需顯示時回傳 None
+    """
+    cfg = dict(cfg_items)
+    close, high, low, volume, ma20, ma60, vol5 = (tail[:, i] for i in range(7))
+
+    # -------------------- 現價與均線（寫入快取時已算好） --------------------
+    current_price = float(close[-1])
+    ma20_val = float(ma20[-1])
+    ma60_val = float(ma60[-1])
+
+    trend_label = '🔴 多頭排列' if ma20_val > ma60_val else '🟢 空頭排列'
+
+    # -------------------- 便宜的條件先淘汰 --------------------
+    if not is_manual:
+        # 均線濾掉低於 MA20 的股票
+        if cfg.get("f_ma_filter", False) and current_price < ma20_val:
+            return None
+        # 價格下限濾掉
+        if current_price < cfg.get("min_price", 0):
+            return None
+
+    # -------------------- 三角 / 箱型訊號 --------------------
+    lookback = cfg.get("p_lookback", 15)
+    x_arr = np.arange(lookback)
+
+    # 高/低價疊成 (2, lookback) 一次擬合
+    slopes, intercepts = fit_lines(np.vstack([high[-lookback:], low[-lookback:]]))
+    slope_high, slope_low = float(slopes[0]), float(slopes[1])
+    intercept_high, intercept_low = float(intercepts[0]), float(intercepts[1])
+
+    signal_mask = 0
+    # 三角收斂：上升與下降趨勢互相收斂
+    if slope_high < -0.001 and slope_low > 0.001:
+        signal_mask |= SIG_TRI
+    # 箱型整理：高低價趨勢平緩
+    if abs(slope_high) < 0.03 and abs(slope_low) < 0.03:
+        signal_mask |= SIG_BOX
+
+    # -------------------- 成交量訊號 --------------------
+    if cfg.get("check_vol", True):
+        vol_today = float(volume[-1])
+        vol_avg5 = float(vol5[-1])
+        if vol_avg5 > 0 and vol_today > vol_avg5 * 1.5:
+            signal_mask |= SIG_VOL
+
+    # -------------------- 是否顯示 --------------------
+    should_display = is_manual
+    if not is_manual:
+        enabled_mask = (
+            (SIG_TRI if cfg.get("check_tri", False) else 0)
+            | (SIG_BOX if cfg.get("check_box", False) else 0)
+            | (SIG_VOL if cfg.get("check_vol", False) else 0)
+        )
+        should_display = bool(signal_mask & enabled_mask)
+
+    if not should_display:
+        return None
+    return {
+        "現價": round(current_price, 2),
+        "趨勢": trend_label,
+        "MA20": round(ma20_val, 2),
+        "MA60": round(ma60_val, 2),
+        "符合訊號": ", ".join(name for bit, name in SIGNAL_NAMES.items() if signal_mask & bit) or "🔍 觀察中",
+        "lines": (slope_high, intercept_high, slope_low, intercept_low, x_arr)
+    }
+
+
 def run_analysis(
     sid: str,
     name: str,
     df: pd.DataFrame,
     cfg: dict,
-    is_manual: bool = False
+    is_manual: bool = False,
+    favorites: set[str] | None = None
 ) -> dict | None:
     """
     分析單檔股票走勢與訊號
@@ -266,6 +688,12 @@ def run_analysis(
     df : 歷史價格資料 (需含 Close, High, Low, Volume)
     cfg : 分析參數設定 (dict)
     is_manual : 是否手動模式，手動模式會直接顯示所有結果
+    favorites : 收藏清單快照（迴圈外取一次傳入）；None 時才讀 session_state
+    
+    計算交給 analyze_tail（依代碼、最後日期、尾段價量與參數快取），
+    這裡只補上收藏狀態與 df 等每次都可能不同的欄位；
+    尾段價量（趨勢線擬合用到的 lookback 根）與參數都沒變時，直接用 session 內的結果，省掉轉型與快取雜湊；
+    同日再次增量更新改寫了較早的高低點時，尾段不同就會重算
     """
     
     # -------------------- 基本檢查 --------------------
@@ -273,81 +701,136 @@ def run_analysis(
     if df.empty or not all(col in df.columns for col in required_cols) or len(df) < 60:
         return None
 
+    lookback = cfg.get("p_lookback", 15)
+    if len(df) < lookback:
+        return None
+
     try:
-        # -------------------- 計算現價與均線 --------------------
-        current_price = float(df['Close'].iloc[-1])
-        ma20_val = float(df['Close'].rolling(window=20).mean().iloc[-1])
-        ma60_val = float(df['Close'].rolling(window=60).mean().iloc[-1])
+        # df 就是快取裡那份時直接用預先轉好的矩陣，否則（少見）現場轉換
+        arr = get_price_array(sid) if price_cache.get(sid) is df else None
+        if arr is None:
+            if "MA20" not in df.columns:
+                df = prepare_price_frame(df.copy())
+            arr = df[ANALYSIS_COLS].to_numpy(dtype=np.float32)
+    except Exception as exc:
+        st.warning(f"⚠️ 股票 {sid} 分析失敗: {exc}")
+        return None
 
-        trend_label = '🔴 多頭排列' if ma20_val > ma60_val else '🟢 空頭排列'
+    cfg_items = tuple((key, cfg[key]) for key in ANALYSIS_CFG_KEYS if key in cfg)
+    # 只看最後一列不夠：趨勢線用整段尾段的高低點擬合，較早的 K 棒被修正時結果也會變
+    memo_key = (sid, df.index[-1], arr[-lookback:].tobytes(), cfg_items, is_manual)
+    memo = st.session_state.analysis_memo
 
-        # -------------------- 三角 / 箱型訊號 --------------------
-        lookback = cfg.get("p_lookback", 15)
-        if len(df) < lookback:
+    if memo_key in memo:
+        memo.move_to_end(memo_key)
+        core = memo[memo_key]
+    else:
+        try:
+            tail = arr[-lookback:].astype(np.float64)
+            core = analyze_tail(sid, str(df.index[-1]), tail, cfg_items, is_manual)
+        except Exception as exc:
+            # 單檔股票失敗不影響整體
+            st.warning(f"⚠️ 股票 {sid} 分析失敗: {exc}")
             return None
+        memo[memo_key] = core
+        if len(memo) > ANALYSIS_MEMO_SIZE:
+            memo.popitem(last=False)
 
-        x_arr = np.arange(lookback)
-        high_prices = df["High"].iloc[-lookback:].values.flatten()
-        low_prices  = df["Low"].iloc[-lookback:].values.flatten()
-
-        slope_high, intercept_high, _, _, _ = linregress(x_arr, high_prices)
-        slope_low,  intercept_low,  _, _, _ = linregress(x_arr, low_prices)
-
-        signals_list = []
-        # 三角收斂：上升與下降趨勢互相收斂
-        if slope_high < -0.001 and slope_low > 0.001:
-            signals_list.append("📐三角收斂")
-        # 箱型整理：高低價趨勢平緩
-        if abs(slope_high) < 0.03 and abs(slope_low) < 0.03:
-            signals_list.append("📦箱型整理")
-
-        # -------------------- 成交量訊號 --------------------
-        if len(df) >= 6 and cfg.get("check_vol", True):
-            vol_today = float(df["Volume"].iloc[-1])
-            vol_prev5 = df["Volume"].iloc[-6:-1]
-            vol_avg5 = vol_prev5.mean() if not vol_prev5.empty else 0
-            if vol_avg5 > 0 and vol_today > vol_avg5 * 1.5:
-                signals_list.append("🚀今日爆量")
-
-        # -------------------- 是否顯示 --------------------
-        should_display = is_manual
-        if not is_manual:
-            has_valid_signal = any([
-                cfg.get("check_tri", False) and any("📐" in s for s in signals_list),
-                cfg.get("check_box", False) and any("📦" in s for s in signals_list),
-                cfg.get("check_vol", False) and any("🚀" in s for s in signals_list)
-            ])
-            should_display = has_valid_signal
-
-            # 均線濾掉低於 MA20 的股票
-            if cfg.get("f_ma_filter", False) and current_price < ma20_val:
-                should_display = False
-            # 價格下限濾掉
-            if current_price < cfg.get("min_price", 0):
-                should_display = False
-
-        # -------------------- 組合返回字典 --------------------
-        if should_display:
-            return {
-                "收藏": sid in st.session_state.favorites,
-                "sid": sid,
-                "名稱": name,
-                "現價": round(current_price, 2),
-                "趨勢": trend_label,
-                "MA20": round(ma20_val, 2),
-                "MA60": round(ma60_val, 2),
-                "符合訊號": ", ".join(signals_list) if signals_list else "🔍 觀察中",
-                "Yahoo": f"https://tw.stock.yahoo.com/quote/{sid.split('.')[0]}",
-                "df": df.copy(),
-                "lines": (slope_high, intercept_high, slope_low, intercept_low, x_arr)
-            }
+    if core is None:
+        return None
 
-    except Exception as exc:
-        # 單檔股票失敗不影響整體
-        st.warning(f"⚠️ 股票 {sid} 分析失敗: {exc}")
+    # -------------------- 組合返回字典 --------------------
+    return {
+        "收藏": sid in (st.session_state.favorites if favorites is None else favorites),
+        "sid": sid,
+        "名稱": name,
+        "現價": core["現價"],
+        "趨勢": core["趨勢"],
+        "MA20": core["MA20"],
+        "MA60": core["MA60"],
+        "符合訊號": core["符合訊號"],
+        "Yahoo": f"https://tw.stock.yahoo.com/quote/{sid.split('.')[0]}",
+        "df": df.iloc[-CHART_BARS:],
+        "lines": core["lines"]
+    }
+
+
+def screen_symbols(symbols: list[str], cfg: dict) -> list[str]:
+    """
+    條件篩選 / 自動掃描的向量化預篩
+    
+    把快取中每檔最後 lookback 根的價量與預算好的 MA20/Vol5 疊成矩陣，一次算完
+    趨勢線斜率、爆量、均線與價格門檻，判斷邏輯與 run_analysis（非手動模式）一致；
+    只回傳可能顯示的代號，再交給 run_analysis 組結果，其餘檔不必逐檔分析
+    """
+    lookback = cfg.get("p_lookback", 15)
+    window = max(60, lookback)
+
+    screened, tails = [], []
+    for sym in symbols:
+        arr = get_price_array(sym)
+        if arr is None or len(arr) < window:
+            continue
+        screened.append(sym)
+        tails.append(arr[-lookback:])
+    if not screened:
+        return []
+
+    data = np.stack(tails).astype(np.float64)  # (N, lookback, 7)
+
+    # 先用只看最後一列的價格門檻 / 均線條件淘汰，剩下的才擬合趨勢線
+    current_price = data[:, -1, 0]
+    passed = ~(current_price < cfg.get("min_price", 0))
+    if cfg.get("f_ma_filter", False):
+        passed &= ~(current_price < data[:, -1, 4])
+    if not passed.all():
+        data = data[passed]
+        screened = [sym for sym, keep in zip(screened, passed) if keep]
+
+    high, low, volume, vol5 = data[:, :, 1], data[:, :, 2], data[:, :, 3], data[:, :, 6]
+    slope_high, _ = fit_lines(high)
+    slope_low, _ = fit_lines(low)
+
+    hit = np.zeros(len(screened), dtype=bool)
+    if cfg.get("check_tri", False):
+        hit |= (slope_high < -0.001) & (slope_low > 0.001)
+    if cfg.get("check_box", False):
+        hit |= (np.abs(slope_high) < 0.03) & (np.abs(slope_low) < 0.03)
+    if cfg.get("check_vol", False):
+        vol_avg5 = vol5[:, -1]
+        hit |= (vol_avg5 > 0) & (volume[:, -1] > vol_avg5 * 1.5)
+
+    return [sym for sym, keep in zip(screened, hit) if keep]
+
+
+def build_basic_result(sid: str, name: str, df: pd.DataFrame) -> dict | None:
+    """
+    收藏模式防呆：run_analysis 資料不足時，仍以現價/均線組出基本顯示列
+    
+    df 為空時回傳 None
+    """
+    if df.empty:
         return None
 
-    return None
+    # 只取尾段平均，不必對整年資料算 rolling 序列
+    close = df['Close'].to_numpy(dtype=np.float64)
+    current_price = float(close[-1])
+    ma20 = float(close[-20:].mean()) if len(close) >= 20 else None
+    ma60 = float(close[-60:].mean()) if len(close) >= 60 else None
+    trend = '🔴 多頭排列' if (ma20 is not None and ma60 is not None and ma20 > ma60) else '🟢 空頭排列'
+    return {
+        "收藏": True,
+        "sid": sid,
+        "名稱": name,
+        "現價": round(current_price, 2),
+        "趨勢": trend,
+        "MA20": round(ma20, 2) if ma20 is not None else None,
+        "MA60": round(ma60, 2) if ma60 is not None else None,
+        "符合訊號": "🔍 觀察中",
+        "Yahoo": f"https://tw.stock.yahoo.com/quote/{sid.split('.')[0]}",
+        "df": df.iloc[-CHART_BARS:],
+        "lines": None
+    }
 
 
 # ────────────────────────────────────────────────
@@ -454,31 +937,50 @@ update_price_button = st.sidebar.button(
 if update_price_button:
     with st.status("正在更新全市場價格資料（約 1800 檔）...", expanded=True) as update_status:
         all_symbols = list(full_db.keys())
+
+        # 快取已涵蓋到最近幾天的代號只抓最後 5 天接上去，其餘（沒有快取或太舊）才下載完整一年
+        recent_cutoff = pd.Timestamp.now().normalize() - INCREMENTAL_MAX_GAP
+        incremental_symbols, full_symbols = [], []
+        for sym in all_symbols:
+            cached = get_cached_price(sym)
+            if cached is not None and cached.index[-1] >= recent_cutoff:
+                incremental_symbols.append(sym)
+            else:
+                full_symbols.append(sym)
+        st.write(f"增量更新 {len(incremental_symbols)} 檔，完整下載 {len(full_symbols)} 檔")
+
+        download_jobs = [
+            (symbols[i : i + PRICE_BATCH_SIZE], period)
+            for symbols, period in ((incremental_symbols, RECENT_PERIOD), (full_symbols, PRICE_HISTORY_PERIOD))
+            for i in range(0, len(symbols), PRICE_BATCH_SIZE)
+        ]
         progress_bar = st.progress(0)
-        batch_size = 80
-        updated_items = 0
-        for batch_idx in range(0, len(all_symbols), batch_size):
-            batch_list = all_symbols[batch_idx : batch_idx + batch_size]
-            try:
-                multi_data = yf.download(
-                    batch_list,
-                    period="1y",
-                    group_by="ticker",
-                    threads=True,
-                    auto_adjust=True
-                )
-                for sym in batch_list:
-                    if sym in multi_data.columns.levels[0]:
-                        price_cache[sym] = multi_data[sym].copy()
-                        updated_items += 1
-            except Exception as batch_err:
-                st.warning(f"批次 {batch_idx//batch_size + 1} 下載失敗：{batch_err}")
-            progress_bar.progress(min((batch_idx + batch_size) / len(all_symbols), 1.0))
-            time.sleep(1.2)
-        save_price_cache(price_cache)
+        updated_count = 0
+        # 請求由 download_throttle 依序放行，上一批的拆檔與指標計算和下一批的下載重疊；
+        # 進度條與警告只在主執行緒更新
+        executor = ThreadPoolExecutor(max_workers=PRICE_DOWNLOAD_WORKERS)
+        try:
+            futures = {
+                executor.submit(download_price_batch, batch_list, period): job_idx
+                for job_idx, (batch_list, period) in enumerate(download_jobs)
+            }
+            for done_count, future in enumerate(as_completed(futures), start=1):
+                try:
+                    batch_updated = future.result()
+                except Exception as batch_err:
+                    st.warning(f"批次 {futures[future] + 1} 下載失敗：{batch_err}")
+                else:
+                    # 每批完成就記入待寫入集合，更新中途被停止或 rerun 時，已下載的部分也不會遺失
+                    st.session_state.dirty_prices.update(batch_updated)
+                    updated_count += len(batch_updated)
+                progress_bar.progress(done_count / len(download_jobs))
+        finally:
+            # 被中斷時不等排隊中的批次；已完成的批次一次寫檔
+            executor.shutdown(wait=False, cancel_futures=True)
+            flush_price_cache()
         st.session_state.last_cache_update = datetime.now()
         update_status.update(
-            label=f"更新完成！處理 {updated_items} 檔資料",
+            label=f"更新完成！處理 {updated_count} 檔資料",
             state="complete"
         )
 
@@ -491,7 +993,8 @@ update_list_button = st.sidebar.button(
 if update_list_button:
     new_data, count = update_stock_json_from_finmind()
     if new_data:
-        st.session_state.full_db = load_stock_database()
+        st.session_state.full_db = load_stock_database(stock_json_mtime())
+        st.session_state.db_indexes = build_db_indexes(st.session_state.full_db)
         full_db = st.session_state.full_db
         st.success("股票清單已更新，請重新選擇模式或產業")
         st.rerun()
@@ -511,14 +1014,7 @@ symbol_list = list(full_db.keys())
 
 # 只有當不是收藏模式且選擇了特定產業才篩選
 if mode_selected != industry_filter != "全部":
-    filtered = []
-    for s in symbol_list:
-        value = full_db.get(s, {})
-        if isinstance(value, dict):
-            category_value = str(value.get("category", "")).strip()
-            if category_value == industry_filter:
-                filtered.append(s)
-    symbol_list = filtered
+    symbol_list = list(industry_index.get(industry_filter, []))
 
     if not symbol_list:
         st.warning(f"⚠️ 找不到產業為「{industry_filter}」的股票，請確認 JSON 是否包含 category 或名稱拼寫正確")
@@ -527,6 +1023,8 @@ if mode_selected != industry_filter != "全部":
 
 # ================= 各模式邏輯 =================
 display_results = []
+auto_scan_symbols = None  # 自動掃描模式才設定，結果改由 auto_scan_fragment 自行掃描與呈現
+favorites = st.session_state.favorites  # 迴圈內只查這份參照，不必每檔都經過 session_state
 
 # -------- 手動查詢模式 --------
 if mode_selected == "🔍 手動查詢":
@@ -552,14 +1050,20 @@ if mode_selected == "🔍 手動查詢":
             # 輸入改變或第一次跑 → 重新分析
             results_temp = []
             with st.spinner("正在分析手動輸入的標的..."):
+                valid_codes = []
                 for code in code_list:
                     sym = code if '.' in code else f"{code}.TW"
                     if sym not in full_db:
                         st.warning(f"找不到股票 {sym}，已跳過")
                         continue
+                    valid_codes.append((code, sym))
+
+                # 沒有快取的代號合併成一次批次下載，不再逐檔連線
+                prefetch_prices([sym for _, sym in valid_codes])
+                for code, sym in valid_codes:
                     df_data = fetch_price(sym)
-                    stock_name = full_db.get(sym, {}).get("name", code)
-                    analysis_result = run_analysis(sym, stock_name, df_data, analysis_cfg, is_manual=True)
+                    stock_name = name_of.get(sym, code)
+                    analysis_result = run_analysis(sym, stock_name, df_data, analysis_cfg, is_manual=True, favorites=favorites)
                     if analysis_result:
                         results_temp.append(analysis_result)
 
@@ -594,16 +1098,18 @@ elif mode_selected == "⚖️ 條件篩選":
             scan_symbols = symbol_list[:max_scan]
             temp_results = []
             with st.status(f"掃描中...（{len(scan_symbols)} 檔，{industry_filter}類）", expanded=True) as scan_status:
+                st.write("補齊缺少的價格資料（批次下載）...")
+                prefetch_prices(scan_symbols)
+                candidates = screen_symbols(scan_symbols, analysis_cfg)
+                st.write(f"向量化預篩完成：{len(candidates)} / {len(scan_symbols)} 檔進入詳細分析")
                 progress_bar = st.progress(0)
-                for idx, sym in enumerate(scan_symbols):
+                for idx, sym in enumerate(candidates):
                     df_data = fetch_price(sym)
-                    stock_name = full_db.get(sym, {}).get("name", "未知")
-                    analysis_result = run_analysis(sym, stock_name, df_data, analysis_cfg, is_manual=False)
+                    stock_name = name_of.get(sym, "未知")
+                    analysis_result = run_analysis(sym, stock_name, df_data, analysis_cfg, is_manual=False, favorites=favorites)
                     if analysis_result:
                         temp_results.append(analysis_result)
-                    progress_bar.progress((idx + 1) / len(scan_symbols))
-                    if (idx + 1) % 50 == 0:
-                        time.sleep(0.05)
+                    progress_bar.progress((idx + 1) / len(candidates))
                 st.session_state.condition_scan_results = temp_results  # 存到專屬暫存
                 st.session_state.results_data = temp_results
                 if not temp_results:
@@ -624,25 +1130,10 @@ elif mode_selected == "⚖️ 條件篩選":
 
 # -------- 自動掃描模式 --------
 elif mode_selected == "⚡ 自動掃描":
-    st_autorefresh(interval=60000, key="auto_scan_refresh")
     st.warning("自動掃描模式啟動，每 60 秒更新一次（限制前 150 檔避免過載）")
     
     auto_scan_limit = min(len(symbol_list), 150)
-    scan_symbols = symbol_list[:auto_scan_limit]
-    temp_results = []
-    
-    with st.spinner(f"自動掃描 {len(scan_symbols)} 檔中..."):
-        for sym in scan_symbols:
-            df_data = fetch_price(sym)
-            stock_name = full_db.get(sym, {}).get("name", "未知")
-            analysis_result = run_analysis(sym, stock_name, df_data, analysis_cfg, is_manual=False)
-            if analysis_result:
-                temp_results.append(analysis_result)
-
-    st.session_state.results_data = temp_results
-    if not temp_results:
-        st.info("⚠️ 自動掃描沒有找到符合條件的股票")
-    display_results = temp_results
+    auto_scan_symbols = symbol_list[:auto_scan_limit]
 
 # -------- 收藏追蹤模式 --------
 # ────────────────────────────────────────────────
@@ -658,80 +1149,35 @@ elif mode_selected == "❤️ 收藏追蹤":
     else:
         st.subheader(f"收藏清單（{len(fav_syms)} 檔）")
 
-        # 每次進入收藏頁，先清空舊資料，避免累積
-        st.session_state.results_data = []
-
-        # 更新報價按鈕
+        # 與掃描模式相同：沒有快取的收藏股先合併批次下載，下面的迴圈都直接命中快取
+        prefetch_prices(fav_syms)
+
+        def build_favorite_results() -> list[dict]:
+            """收藏清單逐檔分析（重複代號只算一次）；分析不出結果時退回基本報價"""
+            results = []
+            for sym in dict.fromkeys(fav_syms):
+                df_data = fetch_price(sym)
+                stock_name = name_of.get(sym, sym)
+                analysis_result = run_analysis(sym, stock_name, df_data, analysis_cfg, is_manual=True, favorites=favorites)
+                if not analysis_result:
+                    # 防呆基本顯示
+                    analysis_result = build_basic_result(sym, stock_name, df_data)
+                if analysis_result:
+                    results.append(analysis_result)
+            return results
+
+        # 每輪只分析一次：按下更新按鈕時在狀態框內產生結果並直接顯示，不再 rerun 後重算一遍
         if st.button("🔄 立即更新收藏報價", type="primary"):
             with st.status("更新收藏股中...", expanded=True) as status:
-                temp_results = []
-                for sym in fav_syms:
-                    df_data = fetch_price(sym)
-                    stock_name = full_db.get(sym, {}).get("name", sym)
-                    analysis_result = run_analysis(sym, stock_name, df_data, analysis_cfg, is_manual=True)
-                    if analysis_result:
-                        temp_results.append(analysis_result)
-                    else:
-                        # 防呆基本顯示
-                        if not df_data.empty:
-                            current_price = float(df_data['Close'].iloc[-1])
-                            ma20 = float(df_data['Close'].rolling(20).mean().iloc[-1]) if len(df_data) >= 20 else None
-                            ma60 = float(df_data['Close'].rolling(60).mean().iloc[-1]) if len(df_data) >= 60 else None
-                            trend = '🔴 多頭排列' if (ma20 is not None and ma60 is not None and ma20 > ma60) else '🟢 空頭排列'
-                            analysis_result = {
-                                "收藏": True,
-                                "sid": sym,
-                                "名稱": stock_name,
-                                "現價": round(current_price, 2),
-                                "趨勢": trend,
-                                "MA20": round(ma20, 2) if ma20 is not None else None,
-                                "MA60": round(ma60, 2) if ma60 is not None else None,
-                                "符合訊號": "🔍 觀察中",
-                                "Yahoo": f"https://tw.stock.yahoo.com/quote/{sym.split('.')[0]}",
-                                "df": df_data.copy() if not df_data.empty else pd.DataFrame(),
-                                "lines": None
-                            }
-                        temp_results.append(analysis_result)
-                
-                st.session_state.results_data = temp_results
-                status.update(label=f"更新完成！共處理 {len(temp_results)} 檔", state="complete")
-            
+                display_results = build_favorite_results()
+                status.update(label=f"更新完成！共處理 {len(display_results)} 檔", state="complete")
             st.success("報價更新完成")
-            st.rerun()  # 更新後重新載入畫面
+        else:
+            display_results = build_favorite_results()
+        st.session_state.results_data = display_results
 
-        # 產生 display_results（從收藏清單重新產生）
-        display_results = []
-        seen_sids = set()
-        for sym in fav_syms:
-            if sym in seen_sids:
-                continue
-            df_data = fetch_price(sym)
-            stock_name = full_db.get(sym, {}).get("name", sym)
-            analysis_result = run_analysis(sym, stock_name, df_data, analysis_cfg, is_manual=True)
-            if analysis_result:
-                display_results.append(analysis_result)
-            else:
-                # 防呆
-                if not df_data.empty:
-                    current_price = float(df_data['Close'].iloc[-1])
-                    ma20 = float(df_data['Close'].rolling(20).mean().iloc[-1]) if len(df_data) >= 20 else None
-                    ma60 = float(df_data['Close'].rolling(60).mean().iloc[-1]) if len(df_data) >= 60 else None
-                    trend = '🔴 多頭排列' if (ma20 is not None and ma60 is not None and ma20 > ma60) else '🟢 空頭排列'
-                    result = {
-                        "收藏": True,
-                        "sid": sym,
-                        "名稱": stock_name,
-                        "現價": round(current_price, 2),
-                        "趨勢": trend,
-                        "MA20": round(ma20, 2) if ma20 is not None else None,
-                        "MA60": round(ma60, 2) if ma60 is not None else None,
-                        "符合訊號": "🔍 觀察中",
-                        "Yahoo": f"https://tw.stock.yahoo.com/quote/{sym.split('.')[0]}",
-                        "df": df_data.copy(),
-                        "lines": None
-                    }
-                    display_results.append(result)
-            seen_sids.add(sym)
+# 本輪各模式新下載的價格統一寫檔一次，而不是每下載一檔就寫一次
+flush_price_cache()
 
 # ────────────────────────────────────────────────
 # 強制補收藏只在收藏模式執行（其他頁面不補）
@@ -746,51 +1192,64 @@ elif mode_selected == "❤️ 收藏追蹤":
 # ────────────────────────────────────────────────
 # 結果呈現區塊（所有模式共用）
 # ────────────────────────────────────────────────
-if display_results:
-    table_records = []
-    for item in display_results:
-        is_favorited = item["sid"] in st.session_state.favorites
-        table_records.append({
-            "收藏": is_favorited,
-            "代碼": item["sid"],
-            "名稱": item["名稱"],
-            "現價": item["現價"],
-            "趨勢": item["趨勢"],
-            "MA20": item["MA20"],
-            "MA60": item["MA60"],
-            "訊號": item["符合訊號"],
-            "Yahoo": item["Yahoo"]
+def render_results(display_results: list[dict]):
+    """結果表（含收藏勾選）與個股 K 線圖；自動掃描片段與其他模式共用"""
+    if display_results:
+        # 逐欄建表（表格欄名 → 結果 dict 的 key），pandas 每欄只推斷一次型別
+        fav_set = st.session_state.favorites
+        table_columns = {
+            "代碼": "sid",
+            "名稱": "名稱",
+            "現價": "現價",
+            "趨勢": "趨勢",
+            "MA20": "MA20",
+            "MA60": "MA60",
+            "訊號": "符合訊號",
+            "Yahoo": "Yahoo"
+        }
+        df_table = pd.DataFrame({
+            "收藏": [item["sid"] in fav_set for item in display_results],
+            **{col: [item[key] for item in display_results] for col, key in table_columns.items()}
         })
-    df_table = pd.DataFrame(table_records)
-
-    is_favorite_mode = (mode_selected == "❤️ 收藏追蹤")
-
-    column_config = {
-        "收藏": st.column_config.CheckboxColumn(
-            "❤️ 收藏",
-            width="small",
-            disabled=False  # 所有頁面都可按，讓未收藏的可以勾
-        ),
-        "Yahoo": st.column_config.LinkColumn("Yahoo", display_text="🔍 Yahoo", width="medium"),
-        "現價": st.column_config.NumberColumn(format="%.2f"),
-        "MA20": st.column_config.NumberColumn(format="%.2f"),
-        "MA60": st.column_config.NumberColumn(format="%.2f"),
-    }
 
-    edited_table = st.data_editor(
-        df_table,
-        column_config=column_config,
-        hide_index=True,
-        use_container_width=True,
-        key=f"editor_{mode_selected}_{industry_filter or 'all'}"
-    )
+        is_favorite_mode = (mode_selected == "❤️ 收藏追蹤")
+
+        column_config = {
+            "收藏": st.column_config.CheckboxColumn("❤️ 收藏", width="small"),
+            "Yahoo": st.column_config.LinkColumn("Yahoo", display_text="🔍 Yahoo", width="medium"),
+            "現價": st.column_config.NumberColumn(format="%.2f"),
+            "MA20": st.column_config.NumberColumn(format="%.2f"),
+            "MA60": st.column_config.NumberColumn(format="%.2f"),
+        }
+
+        # 表格唯讀（st.dataframe 只送一次 Arrow 資料，不像 data_editor 每次互動都回傳整張表），
+        # 收藏改在下方的多選框勾選
+        st.dataframe(
+            df_table,
+            column_config=column_config,
+            hide_index=True,
+            use_container_width=True
+        )
 
-    # 取得使用者在表格中勾選的結果
-    new_checked = set(edited_table[edited_table["收藏"] == True]["代碼"].tolist())
+        table_names = dict(zip(df_table["代碼"], df_table["名稱"]))
+        # 收藏勾選包在表單裡：挑選時不觸發 rerun（自動掃描不重跑片段、收藏頁不重算每檔），按下儲存才一次送出
+        with st.form(key=f"fav_form_{mode_selected}_{industry_filter or 'all'}", border=False):
+            new_checked = set(st.multiselect(
+                "❤️ 收藏（勾選後按下方按鈕儲存）",
+                options=list(table_names),
+                default=[sid for sid in table_names if sid in fav_set],
+                format_func=lambda sid: f"{sid} {table_names[sid]}",
+                key=f"fav_select_{mode_selected}_{industry_filter or 'all'}"
+            ))
 
-    col1, col2 = st.columns([1, 4])
-    with col1:
-        if st.button("💾 儲存收藏變更", type="primary", use_container_width=True, key=f"save_fav_{mode_selected}"):
+            col1, col2 = st.columns([1, 4])
+            with col1:
+                save_favorites = st.form_submit_button("💾 儲存收藏變更", type="primary", use_container_width=True)
+            with col2:
+                if not is_favorite_mode:
+                    st.caption("此處只能新增收藏；已收藏的無法在此取消，請至收藏頁處理")
+
+        if save_favorites:
             current_favs = st.session_state.favorites.copy()
             updated = False
 
@@ -813,76 +1272,108 @@ if display_results:
             if updated:
                 st.rerun()  # 儲存後刷新畫面，讓勾選狀態即時顯示
 
-    with col2:
-        pending_add = len(new_checked - st.session_state.favorites)
-        if pending_add > 0 and not is_favorite_mode:
-            st.caption(f"待新增收藏：{pending_add} 檔（按上方按鈕儲存）")
-        elif pending_add == 0 and not is_favorite_mode:
-            st.caption("目前無新收藏變更（已收藏的無法在此取消，請至收藏頁處理）")
-
-    st.divider()
-    st.subheader("個股 K 線與趨勢線詳圖")
-
-    for item in display_results:
-        with st.expander(
-            f"{item['sid']} {item['名稱']} | {item['符合訊號']} | {item['趨勢']}",
-            expanded=False
-        ):
-            cols = st.columns(3)
-            cols[0].metric("現價", f"{item['現價']:.2f} 元")
-            cols[1].metric("MA20", f"{item['MA20']:.2f}")
-            cols[2].metric("趨勢", item["趨勢"])
-
-            plot_df = item["df"].iloc[-60:].copy()
-            fig = go.Figure()
-
-            fig.add_trace(go.Candlestick(
-                x=plot_df.index,
-                open=plot_df['Open'],
-                high=plot_df['High'],
-                low=plot_df['Low'],
-                close=plot_df['Close'],
-                name="K 線",
-                increasing_line_color="#ef5350",
-                decreasing_line_color="#26a69a"
-            ))
+        st.divider()
+        st.subheader("個股 K 線與趨勢線詳圖")
 
-            if item.get("lines"):
-                sh, ih, sl, il, x_vals = item["lines"]
-                x_dates = plot_df.index[-len(x_vals):]
-                fig.add_trace(go.Scatter(
-                    x=x_dates, y=sh * x_vals + ih,
-                    mode='lines', line=dict(color='red', dash='dash', width=2),
-                    name='壓力線'
-                ))
-                fig.add_trace(go.Scatter(
-                    x=x_dates, y=sl * x_vals + il,
-                    mode='lines', line=dict(color='lime', dash='dash', width=2),
-                    name='支撐線'
-                ))
-
-            try:
-                theme_setting = st.get_option("theme.base")
-                chart_template = "plotly_dark" if theme_setting == "dark" else "plotly_white"
-            except:
-                chart_template = "plotly_white"
-
-            fig.update_layout(
-                height=480,
-                margin=dict(l=10, r=10, t=30, b=10),
-                xaxis_rangeslider_visible=False,
-                template=chart_template
-            )
-
-            st.plotly_chart(fig, use_container_width=True, key=f"chart_{item['sid']}")
+        # 主題、版面與線條樣式每次呈現只決定一次，各圖共用
+        try:
+            theme_setting = st.get_option("theme.base")
+            chart_template = "plotly_dark" if theme_setting == "dark" else "plotly_white"
+        except:
+            chart_template = "plotly_white"
+        chart_layout = dict(
+            height=480,
+            margin=dict(l=10, r=10, t=30, b=10),
+            xaxis_rangeslider_visible=False,
+            template=chart_template
+        )
+        resistance_style = dict(color='red', dash='dash', width=2)
+        support_style = dict(color='lime', dash='dash', width=2)
+
+        for item in display_results:
+            with st.expander(
+                f"{item['sid']} {item['名稱']} | {item['符合訊號']} | {item['趨勢']}",
+                expanded=False
+            ):
+                cols = st.columns(3)
+                cols[0].metric("現價", f"{item['現價']:.2f} 元")
+                cols[1].metric("MA20", f"{item['MA20']:.2f}")
+                cols[2].metric("趨勢", item["趨勢"])
+
+                # 摺疊的 expander 內容照樣會執行；勾選後才建圖，沒看的股票不必組 Figure / 序列化
+                if not st.checkbox("📊 顯示 K 線圖", key=f"show_chart_{item['sid']}"):
+                    continue
+
+                plot_df = item["df"].iloc[-CHART_BARS:]
+                # 日期軸只轉一次成 datetime64 陣列，K 線與趨勢線共用切片，不再建新的 DatetimeIndex
+                x_index = plot_df.index.to_numpy()
+                traces = [go.Candlestick(
+                    x=x_index,
+                    open=plot_df['Open'],
+                    high=plot_df['High'],
+                    low=plot_df['Low'],
+                    close=plot_df['Close'],
+                    name="K 線",
+                    increasing_line_color="#ef5350",
+                    decreasing_line_color="#26a69a"
+                )]
+
+                if item.get("lines"):
+                    sh, ih, sl, il, x_vals = item["lines"]
+                    x_dates = x_index[-len(x_vals):]
+                    traces.append(go.Scatter(
+                        x=x_dates, y=sh * x_vals + ih,
+                        mode='lines', line=resistance_style,
+                        name='壓力線'
+                    ))
+                    traces.append(go.Scatter(
+                        x=x_dates, y=sl * x_vals + il,
+                        mode='lines', line=support_style,
+                        name='支撐線'
+                    ))
+
+                # 建構時一次帶入 data 與 layout，省掉逐次 add_trace / update_layout 的合併
+                fig = go.Figure(data=traces, layout=chart_layout)
+
+                st.plotly_chart(fig, use_container_width=True, key=f"chart_{item['sid']}")
 
-else:
-    if mode_selected == "⚖️ 條件篩選":
-        st.info("尚未執行篩選，請設定條件後按「開始條件篩選」")
-    elif mode_selected == "❤️ 收藏追蹤":
-        st.info("收藏清單為空，快去其他模式加入喜歡的股票吧！")
     else:
-        st.caption("目前無符合條件標的，或尚未執行分析")
+        if mode_selected == "⚖️ 條件篩選":
+            st.info("尚未執行篩選，請設定條件後按「開始條件篩選」")
+        elif mode_selected == "❤️ 收藏追蹤":
+            st.info("收藏清單為空，快去其他模式加入喜歡的股票吧！")
+        else:
+            st.caption("目前無符合條件標的，或尚未執行分析")
+
+@st.fragment(run_every=60)
+def auto_scan_fragment(scan_symbols: list[str], cfg: dict, favorites: set):
+    """
+    自動掃描片段：掃描 + 結果表，每 60 秒只重跑這一段
+    
+    側邊欄、清單載入等其餘部分不跟著重跑；定時重跑時沿用本輪完整執行傳入的參數
+    """
+    temp_results = []
+    with st.spinner(f"自動掃描 {len(scan_symbols)} 檔中..."):
+        prefetch_prices(scan_symbols)
+        for sym in screen_symbols(scan_symbols, cfg):
+            df_data = fetch_price(sym)
+            stock_name = name_of.get(sym, "未知")
+            analysis_result = run_analysis(sym, stock_name, df_data, cfg, is_manual=False, favorites=favorites)
+            if analysis_result:
+                temp_results.append(analysis_result)
+
+    st.session_state.results_data = temp_results
+    if not temp_results:
+        st.info("⚠️ 自動掃描沒有找到符合條件的股票")
+    # 片段重跑時不會經過主流程的 flush，這裡自行寫檔
+    flush_price_cache()
+    render_results(temp_results)
+
+
+if auto_scan_symbols is not None:
+    auto_scan_fragment(auto_scan_symbols, analysis_cfg, favorites)
+else:
+    render_results(display_results)
 
 # ────────────────────────────────────────────────
 # 頁尾資訊
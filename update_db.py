@@ -8,63 +8,155 @@ import requests
 import pandas as pd
 import json
 import io
+import os
+import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 網址清單：strMode=2 是上市，strMode=4 是上櫃
+TARGETS = [
+    {"name": "上市", "url": "https://isin.twse.com.tw/isin/C_public.jsp?strMode=2", "suffix": ".TW"},
+    {"name": "上櫃", "url": "https://isin.twse.com.tw/isin/C_public.jsp?strMode=4", "suffix": ".TWO"}
+]
+
+# 「代號　名稱」欄位（中間是全形空白），模組載入時編譯一次，整欄 str.extract 共用
+SECURITY_RE = re.compile(r"^([^\u3000]+)\u3000([^\u3000]+)$")
+# 代號驗證：必須剛好 4 位數字（濾掉權證、認購證等）
+STOCK_CODE_RE = re.compile(r"\d{4}")
+
+# 輸出檔寫入緩衝區（1 MiB），整份 JSON 只需一次系統呼叫就能落地
+WRITE_BUFFER_SIZE = 1 << 20
+
+# HTTP 快取目錄：保存上次頁面與 ETag/Last-Modified，內容沒變時伺服器只需回 304
+HTTP_CACHE_DIR = Path(".cache") / "isin"
+
+# 只在伺服器真的回 429/5xx 時才指數退避重試（並遵守 Retry-After），正常情況不額外等待
+RETRY_POLICY = Retry(
+    total=5,
+    backoff_factor=0.8,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    respect_retry_after_header=True
+)
+
+def make_session():
+    """建立帶重試策略的 Session；每個市場在自己的子行程各開一個，用完即關"""
+    session = requests.Session()
+    session.headers.update({"User-Agent": "Mozilla/5.0 (taiwan-stock-scanner update_db)"})
+    session.mount("https://", HTTPAdapter(max_retries=RETRY_POLICY))
+    return session
+
+def cached_get(session, url):
+    """
+    帶條件請求的 GET：有快取就送 If-None-Match / If-Modified-Since，
+    伺服器回 304 時直接讀本地頁面，否則下載並更新快取。回傳原始 bytes
+    """
+    cache_key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    meta_path = HTTP_CACHE_DIR / f"{cache_key}.json"
+    body_path = HTTP_CACHE_DIR / f"{cache_key}.html"
+
+    headers = {}
+    if meta_path.exists() and body_path.exists():
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            meta = {}  # 快取損毀就當作沒有，直接完整下載
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=30)
+    if response.status_code == 304:
+        print("♻️ 頁面未變動 (304)，使用本地快取")
+        return body_path.read_bytes()
+    response.raise_for_status()
+
+    # 伺服器有給驗證資訊才值得快取
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag or last_modified:
+        try:
+            HTTP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            body_path.write_bytes(response.content)
+            meta_path.write_text(json.dumps({"etag": etag, "last_modified": last_modified}), encoding="utf-8")
+        except OSError as e:
+            print(f"⚠️ 寫入 HTTP 快取失敗（不影響本次更新）: {e}")
+    return response.content
+
+def fetch_market(target):
+    """抓取單一市場清單，回傳 {代號: 資料}；失敗時回傳空 dict，不影響其他市場"""
+    stocks = {}
+    try:
+        print(f"📡 正在從證交所/櫃買中心抓取【{target['name']}】清單...")
+
+        # 抓取（可能來自 304 快取），並強制以 big5 解碼 (證交所標準)
+        with make_session() as session:
+            html_text = cached_get(session, target['url']).decode('big5', errors='replace')
+
+        # 使用 io.StringIO 包裝，避免 pandas 抓不到正確編碼
+        # 指定 lxml（C 解析器），不讓 pandas 失敗時退回慢很多的 bs4 + html5lib；
+        # match 只轉換含代號欄位的表格，header=0 直接把第一列當標題
+        dfs = pd.read_html(
+            io.StringIO(html_text),
+            match="有價證券代號及名稱",
+            flavor="lxml",
+            header=0
+        )
+        df = dfs[0]
+
+        # 原始格式通常是 "2330　台積電" (中間是全形空白)，整欄一次拆成代號與名稱
+        parts = df['有價證券代號及名稱'].astype(str).str.extract(SECURITY_RE)
+        sids = parts[0].str.strip()
+        names = parts[1].str.strip()
+        # 產業別空白（ETF 等）會讀成 NaN，寫進 JSON 會變成非標準的 NaN，一律補成「其他」
+        industries = df['產業別'].fillna('其他') if '產業別' in df.columns else pd.Series('其他', index=df.index)
+
+        # 過濾條件：格式不符（NaN）或代號不是 4 位數（權證、認購證等）都濾掉
+        keep = sids.str.fullmatch(STOCK_CODE_RE, na=False)
+        stocks = {
+            f"{sid}{target['suffix']}": {
+                "name": name,
+                "category": industry,
+                "market": target['name']
+            }
+            for sid, name, industry in zip(sids[keep], names[keep], industries[keep])
+        }
+        print(f"✅ {target['name']} 處理完成，共計 {len(stocks)} 檔。")
+
+    except Exception as e:
+        print(f"❌ 抓取 {target['name']} 失敗: {e}")
+
+    return stocks
 
 def update_taiwan_stock_list():
     print(f"🚀 [{datetime.now().strftime('%H:%M:%S')}] update_db.py 任務啟動...")
-    
-    # 網址清單：strMode=2 是上市，strMode=4 是上櫃
-    targets = [
-        {"name": "上市", "url": "https://isin.twse.com.tw/isin/C_public.jsp?strMode=2", "suffix": ".TW"},
-        {"name": "上櫃", "url": "https://isin.twse.com.tw/isin/C_public.jsp?strMode=4", "suffix": ".TWO"}
-    ]
-    
+
     full_market_data = {}
-    
-    for target in targets:
-        try:
-            print(f"📡 正在從證交所/櫃買中心抓取【{target['name']}】清單...")
-            
-            # 使用 requests 抓取，並強制指定編碼為 big5 (證交所標準)
-            response = requests.get(target['url'], timeout=30)
-            response.encoding = 'big5'
-            
-            # 使用 io.StringIO 包裝，避免 pandas 抓不到正確編碼
-            dfs = pd.read_html(io.StringIO(response.text))
-            df = dfs[0]
-            
-            # 設定正確的標題列 (第一列通常是標題)
-            df.columns = df.iloc[0]
-            df = df.iloc[1:]
-            
-            count = 0
-            for _, row in df.iterrows():
-                # 原始格式通常是 "2330　台積電" (中間是全形空白)
-                raw_value = str(row['有價證券代號及名稱'])
-                item = raw_value.split('\u3000')
-                
-                if len(item) == 2:
-                    sid, name = item[0].strip(), item[1].strip()
-                    # 過濾條件：代號必須是 4 位數（濾掉權證、認購證等）
-                    if len(sid) == 4 and sid.isdigit():
-                        industry = row.get('產業別', '其他')
-                        full_market_data[f"{sid}{target['suffix']}"] = {
-                            "name": name,
-                            "category": industry,
-                            "market": target['name']
-                        }
-                        count += 1
-            print(f"✅ {target['name']} 處理完成，共計 {count} 檔。")
-            
-        except Exception as e:
-            print(f"❌ 抓取 {target['name']} 失敗: {e}")
+
+    # 上市、上櫃各用一個行程抓取並解析：下載重疊等待，read_html 的 CPU 解析也不受 GIL 限制
+    # map 保持原本的市場順序；每個子行程只發一次請求，Session 在 fetch_market 內自行建立與關閉
+    with ProcessPoolExecutor(max_workers=len(TARGETS)) as executor:
+        for stocks in executor.map(fetch_market, TARGETS):
+            full_market_data |= stocks
 
     # --- 核心動作：無中生有並自動覆蓋 ---
     if full_market_data:
         filename = "taiwan_full_market.json"
         try:
-            with open(filename, "w", encoding="utf-8") as f:
-                json.dump(full_market_data, f, ensure_ascii=False, indent=4)
+            # 先在記憶體序列化完成再一次寫入，避免 json.dump 逐元素呼叫 write()
+            content = json.dumps(full_market_data, ensure_ascii=False, indent=4)
+            # 先寫暫存檔再 os.replace（同檔案系統內為原子操作），中途失敗也不會留下半份 JSON
+            tmp_filename = f"{filename}.tmp"
+            with open(tmp_filename, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, filename)
             print("---")
             print(f"✨ 任務達成！已成功生出並覆蓋 {filename}")
             print(f"📊 目前總兵力：{len(full_market_data)} 檔上市/上櫃股票。")